@@ -1,15 +1,17 @@
 #! /usr/bin/env python
 from __future__ import annotations
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+from concurrent.futures import ThreadPoolExecutor
 import dataclasses as dc
 import datetime
-from functools import total_ordering
+import errno
+from functools import cached_property, lru_cache, total_ordering
 import hashlib
-from itertools import dropwhile, takewhile
 import json
 import os
 import re
 import shutil
+import stat
 import subprocess
 import sys
 import time
@@ -23,6 +25,16 @@ DRY_RUN = False
 EXPLICIT_CONFIG_FILE = "type1"
 AUTO_EFI_CONFIG = "type2"
 
+HASH_CHUNK_SIZE = 1024 * 1024
+HASH_DIGEST_SIZE = 16
+EXTERNAL_HASH_MIN_SIZE = 16 * 1024 * 1024
+MAX_IO_WORKERS = 3
+# Copying an initialized hash is cheaper than constructing a new one for every file
+HASH_PROTOTYPE = hashlib.blake2b(digest_size=HASH_DIGEST_SIZE)
+
+LIFEBOAT_PREFIX = 'lifeboat_'
+CAMEL_CASE_RE = re.compile(r'([a-z])([A-Z])')
+
 
 class LifeboatError(ValueError):
     pass
@@ -31,10 +43,12 @@ class LifeboatError(ValueError):
 def main(*, default_sort_key: str, default_version: str, max_lifeboats: int, default_config_path: Optional[str]):
     if max_lifeboats < 1:
         raise LifeboatError(f'max_lifeboats{max_lifeboats} must be > 1')
+    # mtimes are only as precise as the filesystem clock, so don't trust hashes from a previous run
+    _cached_content_hash.cache_clear()
+    configs = get_bootctl_entries()
     if not default_config_path:
-        default_config_path = get_default_config_path()
+        default_config_path = get_default_config_path(configs)
 
-    configs = get_bootctl_entries()
     default_config = next((x for x in configs if x.path == default_config_path), None)
     if not default_config:
         raise LifeboatError(f'Could not find {default_config_path} in `bootcttl list`')
@@ -43,21 +57,23 @@ def main(*, default_sort_key: str, default_version: str, max_lifeboats: int, def
     if default_config.is_lifeboat():
         raise LifeboatError(f'{default_config.basename()} is a lifeboat config and cannot be used as the default')
 
+    # Fill in all the missing fields at once, so the config is only rewritten once
+    missing_fields: Dict[str, list[str]] = {}
     if not default_config.sort_key:
-        default_config = dc.replace(default_config, sort_key=[
-                                    default_sort_key], autosave=True)
-
+        missing_fields['sort_key'] = [default_sort_key]
     if not default_config.version:
-        default_config = dc.replace(default_config, version=[default_version], autosave=True)
+        missing_fields['version'] = [default_version]
+    if missing_fields:
+        default_config = dc.replace(default_config, autosave=True, **missing_fields)
 
-    lifeboats = [x for x in configs if x.is_lifeboat() and x.type == EXPLICIT_CONFIG_FILE]
-    lifeboats.sort(reverse=True)  # Sort from newest to oldest
-    match = next((x for x in lifeboats if x.equivalent(default_config)), None)
+    # Sort from oldest to newest
+    lifeboats = sorted((x for x in configs if x.is_lifeboat() and x.type == EXPLICIT_CONFIG_FILE), key=Config.timestamp)
+    match = next((x for x in reversed(lifeboats) if x.equivalent(default_config)), None)
     if match:
         print(f'{default_config.basename()} is already backed up to {match.basename()}\nNothing to do')
     else:
-        while len(lifeboats) >= max_lifeboats:
-            lifeboat = lifeboats.pop()
+        # Make room for the new lifeboat by evicting the oldest ones
+        for lifeboat in lifeboats[:max(len(lifeboats) - max_lifeboats + 1, 0)]:
             print(f'Deleting old lifeboat {lifeboat.basename()}')
             lifeboat.remove()
 
@@ -87,6 +103,7 @@ class Config:
     CONF_FIELDS_ORDERED = ['title', 'version', 'machine_id', 'sort_key', 'linux', 'initrd',
                    'efi', 'options', 'devicetree', 'devicetree_overlay', 'architecture']
     CONF_FIELDS = set(CONF_FIELDS_ORDERED)
+    CONF_FIELDS_DASHED = [(field, field.replace('_', '-')) for field in CONF_FIELDS_ORDERED]
     METADATA_FIELDS = {'path', 'root', 'autosave'}
     BOOTCTL_FIELDS = CONF_FIELDS | {'path', 'root', 'is_default', 'type'}
     FIELDS_WITH_FILES = {'linux', 'initrd', 'efi'}
@@ -97,10 +114,9 @@ class Config:
         def unbox(x: Union[str, list[str]]) -> str: return x[0] if isinstance(x, list) else x
         def box(x: Union[str, list[str]]) -> list[str]: return x if isinstance(x, list)else [x]
         # Convert camelCase into snake_case (simple version)
-        data = {re.sub(r'([a-z])([A-Z])', r'\1_\2', k).lower(): v for k, v in data.items()}
-        fieldTypes = {field.name: field.type for field in dc.fields(Config)}
+        data = {CAMEL_CASE_RE.sub(r'\1_\2', k).lower(): v for k, v in data.items()}
         args: Any = {
-            key: box(value) if fieldTypes[key] == 'list[str]' else unbox(value)
+            key: box(value) if CONFIG_FIELD_TYPES[key] == 'list[str]' else unbox(value)
             for key, value in data.items()
             if key in cls.BOOTCTL_FIELDS
         }
@@ -119,15 +135,21 @@ class Config:
         # See https://systemd.io/BOOT_LOADER_SPECIFICATION/#version-order
         with FileTracker() as tracker:
             new_args: Dict[str, list[str]] = {}
-            with Chroot(self.root):
+            with RootHandle(self.root) as root, ThreadPoolExecutor(max_workers=MAX_IO_WORKERS) as pool:
+                copies = []
                 for field in self.FIELDS_WITH_FILES:
                     new_args[field] = []
                     for file in getattr(self, field):
                         dest = self._lifeboat_path(file, ts)
-                        copy_file(file, dest)
-                        tracker.track(dest)
+                        copies.append((dest, pool.submit(copy_file, root, file, dest)))
                         new_args[field].append(dest)
 
+                for dest, future in copies:
+                    if future.exception() is None:
+                        tracker.track(dest, root=self.root)
+                for _dest, future in copies:
+                    future.result()
+
             if self.title:
                 title = self.title[0]
             else:
@@ -159,35 +181,57 @@ class Config:
         return config
 
     def is_lifeboat(self) -> bool:
-        try:
-            self.timestamp()
-            return True
-        except ValueError:
-            return False
+        return self._ts is not None
 
     def timestamp(self) -> int:
-        try:
-            match = re.search(r'^lifeboat_(\d+)_', self.basename())
-            if match is None:
-                raise LifeboatError(f"{self.path} does not contain a timestamp")
-            return int(match.group(1))
-        except Exception as e:
-            raise LifeboatError(f'{self.basename()} is not a lifeboat with a valid timestamp') from e
+        if self._ts is None:
+            raise LifeboatError(f'{self.basename()} is not a lifeboat with a valid timestamp')
+        return self._ts
+
+    @cached_property
+    def _ts(self) -> Optional[int]:
+        # Parsed once per instance, since sorting compares the same configs many times
+        # Equivalent to matching ^lifeboat_(\d+)_ but without the regex engine
+        basename = self.basename()
+        if not basename.startswith(LIFEBOAT_PREFIX):
+            return None
+        end = basename.find('_', len(LIFEBOAT_PREFIX))
+        digits = basename[len(LIFEBOAT_PREFIX):end]
+        return int(digits) if end >= 0 and digits.isdecimal() else None
 
     def equivalent(self, other: Config) -> bool:
         try:
-            return all(
-                {self._md5(filepath) for filepath in getattr(self, field)} == {self._md5(filepath) for filepath in getattr(other, field)} if field in Config.FIELDS_WITH_FILES
-                else getattr(self, field) == getattr(other, field)
-                for field in Config.CONF_FIELDS - Config.EQUIVALENCY_IGNORE_FIELDS)
-        except Md5Error as e:
+            # Compare the plain fields first, so files are only inspected when everything else matches
+            if self._compare_tuple != other._compare_tuple:
+                return False
+            unresolved = []
+            with RootHandle(self.root) as our_root, RootHandle(other.root) as their_root:
+                for field in Config.FIELDS_WITH_FILES:
+                    ours = [our_root.fingerprint(filepath) for filepath in getattr(self, field)]
+                    theirs = [their_root.fingerprint(filepath) for filepath in getattr(other, field)]
+                    # Files with different sizes can never hash the same, and the same inode is trivially identical,
+                    # so only fall back to reading the file contents when neither check is conclusive
+                    if {x.size for x in ours} != {x.size for x in theirs}:
+                        return False
+                    if set(ours) != set(theirs):
+                        unresolved.append((field, ours, theirs))
+            if not unresolved:
+                return True
+
+            # Hash all the remaining files at once, so reading one file overlaps with the others
+            with ThreadPoolExecutor(max_workers=MAX_IO_WORKERS) as pool:
+                hashes = [(pool.map(self._content_hash, getattr(self, field), ours),
+                           pool.map(other._content_hash, getattr(other, field), theirs))
+                          for field, ours, theirs in unresolved]
+                return all(set(our_hashes) == set(their_hashes) for our_hashes, their_hashes in hashes)
+        except HashError as e:
             print(
                 f'Warning: Could not open {e.filepath}. The config can not be considered equivalent because this file is missing')
             return False
 
     def to_conf(self) -> str:
-        return '\n'.join([f'{re.sub("_", "-", field)}\t{val}'
-                          for field in Config.CONF_FIELDS_ORDERED
+        return '\n'.join([f'{dashed}\t{val}'
+                          for field, dashed in Config.CONF_FIELDS_DASHED
                           for val in getattr(self, field)])
 
     def write(self):
@@ -207,34 +251,40 @@ class Config:
             raise LifeboatError(f'Could not save config {self.path}') from e
 
     def remove(self):
-        for field in Config.FIELDS_WITH_FILES:
-            for file in getattr(self, field):
-                delete_file(self.root, file)
+        delete_files(self.root, [file for field in Config.FIELDS_WITH_FILES for file in getattr(self, field)])
         if self.type == EXPLICIT_CONFIG_FILE:
             delete_file('/', self.path)
 
-    def _md5(self, filepath) -> str:
-        with Chroot(self.root):
-            try:
-                with open(filepath, 'rb') as fp:
-                    return hashlib.md5(fp.read()).hexdigest()
-            except Exception as e:
-                raise Md5Error(filepath, f'Could not determine the md5 has for {filepath}') from e
+    @cached_property
+    def _compare_tuple(self) -> tuple[list[str], ...]:
+        return tuple(getattr(self, field) for field in Config.CONF_FIELDS_ORDERED
+                     if field not in Config.EQUIVALENCY_IGNORE_FIELDS and field not in Config.FIELDS_WITH_FILES)
+
+    def _content_hash(self, filepath: str, fingerprint: Fingerprint) -> str:
+        return _cached_content_hash(self.root, filepath, fingerprint)
 
     def _lifeboat_path(self, filepath: str, ts: int) -> str:
-        dir = os.path.dirname(filepath)
-        name = os.path.basename(filepath)
-        return os.path.join(dir, f"lifeboat_{ts}_{name}")
+        # Boot loader paths always use /, so splitting on it directly is the same as dirname/basename/join
+        sep = filepath.rfind('/')
+        return f"{filepath[:sep + 1]}{LIFEBOAT_PREFIX}{ts}_{filepath[sep + 1:]}"
+
+    def __hash__(self) -> int:
+        # Only hash the immutable fields. This stays consistent with the generated __eq__, which compares every field
+        return hash((self.path, self.root, self.type))
 
     def __lt__(self, other: Config) -> bool:
-        if self.is_lifeboat() and other.is_lifeboat():
-            return self.timestamp() < other.timestamp()
+        if self._ts is not None and other._ts is not None:
+            return self._ts < other._ts
         elif self.is_lifeboat() and not other.is_lifeboat():
             return False
         else:
             return self.path < other.path
 
 
+# Computed once, rather than introspecting the dataclass for every bootctl entry
+CONFIG_FIELD_TYPES = {field.name: field.type for field in dc.fields(Config)}
+
+
 def now() -> int: return int(time.time())
 
 
@@ -246,7 +296,57 @@ class ChrootError(LifeboatError):
     pass
 
 
-class Md5Error(LifeboatError):
+class Fingerprint(NamedTuple):
+    dev: int
+    ino: int
+    size: int
+    mtime_ns: int
+
+
+def _relpath(filepath: str) -> str:
+    # Absolute paths would ignore dir_fd, so treat them as relative to the root
+    # Like chroot, /.. is the root itself, so normalize first to keep the path from escaping it
+    return os.path.normpath('/' + filepath).lstrip('/') or '.'
+
+
+@lru_cache(maxsize=None)
+def _cached_content_hash(root: str, filepath: str, fingerprint: Fingerprint) -> str:
+    # The fingerprint is part of the cache key, so a file modified since it was last hashed is hashed again
+    if fingerprint.size == 0:
+        return HASH_PROTOTYPE.hexdigest()  # Nothing to read, every empty file hashes the same
+
+    # This runs on worker threads, so resolve the path against the root instead of changing the process-wide chroot
+    fullpath = os.path.join(root, _relpath(filepath))
+    if fingerprint.size > EXTERNAL_HASH_MIN_SIZE:
+        b2sum = shutil.which('b2sum')
+        if b2sum:
+            return _b2sum(b2sum, filepath, fullpath)
+
+    try:
+        with open(fullpath, 'rb', buffering=0) as fp:
+            if hasattr(hashlib, 'file_digest'):  # python 3.11+
+                return hashlib.file_digest(fp, HASH_PROTOTYPE.copy).hexdigest()
+            digest = HASH_PROTOTYPE.copy()
+            for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+            return digest.hexdigest()
+    except Exception as e:
+        raise HashError(filepath, f'Could not determine the hash for {filepath}') from e
+
+
+def _b2sum(b2sum: str, filepath: str, fullpath: str) -> str:
+    # coreutils hashes large files faster than a python read loop, and produces the same digest as hashlib.blake2b
+    # Feed the file on stdin, since b2sum escapes unusual file names in its output
+    try:
+        with open(fullpath, 'rb') as fp:
+            result = subprocess.run([b2sum, '--length', str(HASH_DIGEST_SIZE * 8), '-'],
+                                    stdin=fp, stdout=subprocess.PIPE, check=True)
+        return result.stdout.decode('utf8').split(maxsplit=1)[0]
+    except Exception as e:
+        raise HashError(filepath, f'Could not determine the hash for {filepath}') from e
+
+
+class HashError(LifeboatError):
     def __init__(self, filepath, *args, **kwargs):
         self.filepath = filepath
         super().__init__(*args, **kwargs)
@@ -300,6 +400,53 @@ class Chroot:
             raise ChrootError(f'Could not recover chroot from {self.filepath}') from e
 
 
+# Resolves paths relative to a root directory with the *at() syscalls, instead of chroot-ing into it
+class RootHandle:
+    def __init__(self, filepath: str):
+        self.filepath = filepath
+        self.fd = -1
+
+    def __enter__(self) -> RootHandle:
+        try:
+            self.fd = os.open(self.filepath, os.O_RDONLY | os.O_DIRECTORY)
+        except Exception as e:
+            raise LifeboatError(f'Could not open {self.filepath}') from e
+        return self
+
+    def __exit__(
+        self, exc_type: Optional[Type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]
+    ) -> Optional[bool]:
+        os.close(self.fd)
+        self.fd = -1
+        return False
+
+    def open(self, filepath: str, flags: int, mode: int = 0o777) -> int:
+        return os.open(_relpath(filepath), flags, mode, dir_fd=self.fd)
+
+    def stat(self, filepath: str) -> os.stat_result:
+        return os.stat(_relpath(filepath), dir_fd=self.fd)
+
+    def remove(self, filepath: str):
+        os.remove(_relpath(filepath), dir_fd=self.fd)
+
+    def fsync_dir(self, dirpath: str):
+        try:
+            fd = self.open(dirpath, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print(f'Error {e} syncing {self.filepath}:{dirpath}, continuing')
+
+    def fingerprint(self, filepath: str) -> Fingerprint:
+        try:
+            st = self.stat(filepath)
+            return Fingerprint(dev=st.st_dev, ino=st.st_ino, size=st.st_size, mtime_ns=st.st_mtime_ns)
+        except Exception as e:
+            raise HashError(filepath, f'Could not stat {filepath}') from e
+
+
 class FileTracker:
     class File(NamedTuple):
         path: str
@@ -310,15 +457,20 @@ class FileTracker:
 
     def __enter__(self) -> FileTracker: return self
 
-    def track(self, filepath: str):
-        self.files.append(FileTracker.File(path=filepath, root=Chroot.roots[-1].path if Chroot.roots else '/'))
+    def track(self, filepath: str, root: Optional[str] = None):
+        if root is None:
+            root = Chroot.roots[-1].path if Chroot.roots else '/'
+        self.files.append(FileTracker.File(path=filepath, root=root))
 
     def __exit__(
         self, exc_type: Optional[Type[BaseException]], exc: Optional[BaseException], traceback: Optional[TracebackType]
     ) -> Optional[bool]:
         if exc is not None and not isinstance(exc, ChrootError):
+            by_root: Dict[str, list[str]] = {}
             for file in self.files:
-                delete_file(file.root, file.path)
+                by_root.setdefault(file.root, []).append(file.path)
+            for root, filepaths in by_root.items():
+                delete_files(root, filepaths)
         return False
 
 
@@ -334,58 +486,120 @@ def get_bootctl_entries() -> list[Config]:
     return [Config.from_bootctl(x) for x in entries if 'root' in x]
 
 
+@lru_cache(maxsize=None)
 def get_default_path(path_type: str) -> str:
     return bootctl([f'--print-{path_type}-path'])
 
 
-def get_default_config_path() -> str:
-    entries = get_bootctl_entries()
+def get_default_config_path(entries: Optional[list[Config]] = None) -> str:
+    if entries is None:
+        entries = get_bootctl_entries()
     defaults = [x for x in entries if x.is_default]
     if len(defaults) != 1:
         raise LifeboatError('Could not determine the default entry from bootctl')
     return defaults[0].path
 
 
-def copy_file(src: str, dest: str):
+def copy_file(root: RootHandle, src: str, dest: str):
     global DRY_RUN
-    if not os.path.exists(src):
-        raise LifeboatError(
-            f"Copying {os.path.basename(src)} to {os.path.basename(dest)} failed because {os.path.basename(src)} doesn't exist")
-    print(f'Copying {src} to {dest}')
-    if os.path.exists(dest):
-        raise LifeboatError(f'Copying {os.path.basename(src)} failed because {os.path.basename(dest)} already exists')
-
-    if DRY_RUN:
-        print(f'--dry-run prevents copying {os.path.basename(src)} to {os.path.basename(dest)}')
-        return
     try:
-        shutil.copy2(src, dest)
-        st = os.stat(src)
-        os.chown(dest, st.st_uid, st.st_gid)
+        src_fd = root.open(src, os.O_RDONLY)
+    except FileNotFoundError as e:
+        raise LifeboatError(
+            f"Copying {os.path.basename(src)} to {os.path.basename(dest)} failed because {os.path.basename(src)} doesn't exist") from e
     except Exception as e:
         raise LifeboatError(f'Error copying {os.path.basename(src)} to {os.path.basename(dest)} failed') from e
 
-
-def delete_file(root: str, filepath: str):
-    if not filepath:
-        print(f'Refusing to delete empty file at {root}')
-        return
-
-    with Chroot(root):
-        global DRY_RUN
+    with os.fdopen(src_fd, 'rb') as src_fp:
+        print(f'Copying {src} to {dest}')
         if DRY_RUN:
-            print(f'--dry-run prevents deleting {root}:{filepath}')
+            try:
+                root.stat(dest)
+                raise LifeboatError(f'Copying {os.path.basename(src)} failed because {os.path.basename(dest)} already exists')
+            except FileNotFoundError:
+                pass
+            print(f'--dry-run prevents copying {os.path.basename(src)} to {os.path.basename(dest)}')
             return
+
+        # O_EXCL makes the "don't overwrite" check and the create a single atomic syscall
         try:
-            os.remove(filepath)
-            print(f'Removed {root}:{filepath}')
+            dest_fd = root.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError as e:
+            raise LifeboatError(f'Copying {os.path.basename(src)} failed because {os.path.basename(dest)} already exists') from e
+        except Exception as e:
+            raise LifeboatError(f'Error copying {os.path.basename(src)} to {os.path.basename(dest)} failed') from e
+
+        try:
+            with os.fdopen(dest_fd, 'wb') as dest_fp:
+                st = os.fstat(src_fp.fileno())
+                _copy_contents(src_fp.fileno(), dest_fp.fileno(), st.st_size)
+                os.fchown(dest_fp.fileno(), st.st_uid, st.st_gid)
+                os.fchmod(dest_fp.fileno(), stat.S_IMODE(st.st_mode))
+                os.utime(dest_fp.fileno(), ns=(st.st_atime_ns, st.st_mtime_ns))
+        except Exception as e:
+            # We created dest, so don't leave a partial copy behind
+            try:
+                root.remove(dest)
+            except OSError:
+                pass
+            raise LifeboatError(f'Error copying {os.path.basename(src)} to {os.path.basename(dest)} failed') from e
+
+
+def _copy_contents(src_fd: int, dest_fd: int, size: int):
+    # copy_file_range can reflink on btrfs/xfs. It isn't supported across filesystems or on older kernels,
+    # so finish the copy with sendfile in that case. Both keep the data in the kernel
+    offset = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                copied = os.copy_file_range(src_fd, dest_fd, size - offset)
+                if copied == 0:
+                    break
+                offset += copied
+            return
         except OSError as e:
-            print(f'Error {e} removing {root}:{filepath}, continuing')
-            pass
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+
+    while offset < size:
+        sent = os.sendfile(dest_fd, src_fd, offset, size - offset)
+        if sent == 0:
+            break
+        offset += sent
+
+
+def delete_file(root: str, filepath: str):
+    delete_files(root, [filepath])
+
+
+def delete_files(root: str, filepaths: list[str]):
+    global DRY_RUN
+    try:
+        with RootHandle(root) as handle:
+            removed_dirs: set[str] = set()
+            for filepath in filepaths:
+                if not filepath:
+                    print(f'Refusing to delete empty file at {root}')
+                    continue
+                if DRY_RUN:
+                    print(f'--dry-run prevents deleting {root}:{filepath}')
+                    continue
+                try:
+                    handle.remove(filepath)
+                    removed_dirs.add(os.path.dirname(filepath))
+                    print(f'Removed {root}:{filepath}')
+                except OSError as e:
+                    print(f'Error {e} removing {root}:{filepath}, continuing')
+
+            # Flush the directory entries once, after all the removals
+            for dirpath in removed_dirs:
+                handle.fsync_dir(dirpath)
+    except LifeboatError as e:
+        print(f'Error {e} removing files from {root}, continuing')
 
 
 if __name__ == '__main__':
-    current_version = subprocess.run(['uname', '-r'], stdout=subprocess.PIPE).stdout.decode('utf8').strip()
+    current_version = os.uname().release
     parser = ArgumentParser(description='Clone the boot entry if it has changed',
                             formatter_class=ArgumentDefaultsHelpFormatter)
     parser.add_argument('-n', '--max-lifeboats', type=int, default=2)
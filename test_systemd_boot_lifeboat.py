@@ -1,43 +1,118 @@
+import atexit
 import dataclasses as dc
-from systemd_boot_lifeboat import Config, Chroot, ChrootError, FileTracker, pretty_date, main, EXPLICIT_CONFIG_FILE, AUTO_EFI_CONFIG
-from multiprocessing.sharedctypes import Value
+from systemd_boot_lifeboat import Config, Chroot, ChrootError, FileTracker, pretty_date, main, EXPLICIT_CONFIG_FILE, AUTO_EFI_CONFIG, RootHandle, _cached_content_hash
+import errno
+import mmap
 import os
+from pathlib import Path
 import shutil
 import re
-from tempfile import TemporaryDirectory
-from typing import Dict, TypedDict, Union
+from tempfile import TemporaryDirectory, mkdtemp
+import threading
+from typing import Dict, Optional, TypedDict, Union
 import unittest
 from unittest.mock import patch
 
+# One "key value" pair per line. Comments and blank lines don't match, since a key can't start with # or whitespace
+ENTRY_RE = re.compile(rb'^[ \t]*([A-Za-z0-9_-]+)[ \t]+(.+?)[ \t]*$', re.MULTILINE)
+DASH_TO_UNDERSCORE = bytes.maketrans(b'-', b'_')
+
+TEST_TMPDIR_PARENT = os.environ.get('LIFEBOAT_TEST_TMPDIR', '/dev/shm')
+_scratch_root: list[Optional[str]] = []
+
+
+def scratch_root() -> Optional[str]:
+    # The tests create lots of tiny files, so keep them on a ramdisk when one is available
+    # mkdtemp creates a fresh directory only we can write to, so nobody else can swap it out from under root
+    if not _scratch_root:
+        try:
+            tmpdir = mkdtemp(prefix='lifeboat-tests-', dir=TEST_TMPDIR_PARENT)
+            atexit.register(shutil.rmtree, tmpdir, ignore_errors=True)
+            _scratch_root.append(tmpdir)
+        except OSError:
+            _scratch_root.append(None)
+    return _scratch_root[0]
+
+
+def temporary_directory() -> TemporaryDirectory:
+    return TemporaryDirectory(dir=scratch_root())
+
+
+def esp_template() -> TemporaryDirectory:
+    template = temporary_directory()
+    os.makedirs(os.path.join(template.name, 'loader', 'entries'))
+    os.makedirs(os.path.join(template.name, 'EFI', 'Arch'))
+    return template
+
+
+def copy_template(template: TemporaryDirectory, dest: str):
+    # Hardlink the files instead of copying them. Tests must not modify template files in place
+    shutil.copytree(template.name, dest, dirs_exist_ok=True, copy_function=os.link)
+
 
 class TestConfig(unittest.TestCase):
+    SEED_FILES = {
+        'EFI/Arch/linux.efi': 'my cool efi',
+        'vmlinuz-linux': 'my cool /linux',
+        'initramfs-linux.img': 'my cool /initramfs-linux.img',
+        'intel-ucode.img': 'my cool /intel-ucode.img',
+        'amd-ucode.img': 'my cool /amd-ucode.img',
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.template = esp_template()
+        # Write the seed files once. Subtests hardlink them into place, since create_lifeboat only reads them
+        cls.seed_dir = temporary_directory()
+        for name, contents in cls.SEED_FILES.items():
+            seed_path = os.path.join(cls.seed_dir.name, name)
+            os.makedirs(os.path.dirname(seed_path), exist_ok=True)
+            with open(seed_path, 'w', encoding='utf8') as fp:
+                fp.write(contents)
+
+        # Patch once for the whole class. Each test points the holder at its own directory
+        cls.default_path_holder = ['']
+        cls.patcher = patch('systemd_boot_lifeboat.get_default_path', lambda x: cls.default_path_holder[0])
+        cls.patcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.patcher.stop()
+        cls.seed_dir.cleanup()
+        cls.template.cleanup()
+
+    def seed(self):
+        for name in self.SEED_FILES:
+            src = os.path.join(self.seed_dir.name, name)
+            dest = os.path.join(self.tmp.name, name)
+            try:
+                os.link(src, dest)
+            except OSError:
+                shutil.copyfile(src, dest)
+
     def setUp(self):
         if os.getuid() != 0:
             self.skipTest('Must run unit tests as root')
 
         self.maxDiff = None
-        self.tmp = TemporaryDirectory()
+        self.tmp = temporary_directory()
+        self.cleanup_threads: list[threading.Thread] = []
         self.reset()
-
-        default_path = self.tmp.name
-        get_default_path = lambda x: default_path
-
-        self.patcher = patch('systemd_boot_lifeboat.get_default_path', get_default_path)
-        self.patcher.start()
+        self.default_path_holder[0] = self.tmp.name
 
     def reset(self):
-        for filename in os.listdir(self.tmp.name):
-            filepath = os.path.join(self.tmp.name, filename)
-            if os.path.isfile(filepath):
-                os.remove(filepath)
-            else:
-                shutil.rmtree(filepath)
-        os.makedirs(os.path.join(self.tmp.name, 'loader', 'entries'), exist_ok=True)
-        os.makedirs(os.path.join(self.tmp.name, 'EFI', 'Arch'), exist_ok=True)
+        # Move the old tree out of the way and delete it in the background, so the next subtest starts immediately
+        trash = mkdtemp(dir=os.path.dirname(self.tmp.name))
+        os.rename(self.tmp.name, os.path.join(trash, 'esp'))
+        cleanup = threading.Thread(target=shutil.rmtree, args=(trash,))
+        cleanup.start()
+        self.cleanup_threads.append(cleanup)
+        copy_template(self.template, self.tmp.name)
 
     def tearDown(self) -> None:
         self.tmp.cleanup()
-        self.patcher.stop()
+        for cleanup in self.cleanup_threads:
+            cleanup.join()
         super().tearDown()
 
     def test_from_bootctl(self):
@@ -65,8 +140,35 @@ class TestConfig(unittest.TestCase):
             with self.subTest(test['name']):
                 self.assertEqual(test['expected'], Config.from_bootctl(test['input']))
 
+    def test_to_conf(self):
+        config = Config(path=os.path.join(self.tmp.name, "loader/entries/arch.conf"), root=self.tmp.name,
+                        title=['Arch Linux'], sort_key=['linux'], linux=['/vmlinuz-linux'],
+                        initrd=['/intel-ucode.img', '/initramfs-linux.img'], devicetree_overlay=['a.dtbo'])
+        self.assertEqual('title\tArch Linux\nsort-key\tlinux\nlinux\t/vmlinuz-linux\ninitrd\t/intel-ucode.img\n'
+                         'initrd\t/initramfs-linux.img\ndevicetree-overlay\ta.dtbo', config.to_conf())
+
+    def test_timestamp(self):
+        tests: list[tuple[str, Union[int, None]]] = [
+            ('lifeboat_12345_arch.conf', 12345),
+            ('lifeboat_12345_', 12345),
+            ('arch.conf', None),
+            ('lifeboat__arch.conf', None),
+            ('lifeboat_12345', None),
+            ('lifeboat_123a_arch.conf', None),
+            ('my_lifeboat_12345_arch.conf', None),
+        ]
+        for name, expected in tests:
+            with self.subTest(name):
+                config = Config(path=os.path.join(self.tmp.name, 'loader', 'entries', name), root=self.tmp.name)
+                self.assertEqual(expected is not None, config.is_lifeboat())
+                if expected is None:
+                    self.assertRaises(ValueError, config.timestamp)
+                else:
+                    self.assertEqual(expected, config.timestamp())
+
     def test_create_lifeboat(self):
         ts = 12345
+        pretty_ts = pretty_date(ts)
 
         class Test(TypedDict):
             name: str
@@ -79,21 +181,21 @@ class TestConfig(unittest.TestCase):
                 config=Config(path=os.path.join(self.tmp.name, "loader/entries/arch.conf"), root=self.tmp.name,
                               title=['Arch Linux'], efi=["/EFI/Arch/linux.efi"], sort_key=["linux"], version=["linux5.19"], autosave=True, type=EXPLICIT_CONFIG_FILE),
                 expected=Config(path=os.path.join(self.tmp.name, "loader/entries/lifeboat_12345_arch.conf"), root=self.tmp.name,
-                                title=[f'Arch Linux @{pretty_date(ts)}'], efi=["/EFI/Arch/lifeboat_12345_linux.efi"], sort_key=["linux"], version=["-linux5.19-12345"], type=EXPLICIT_CONFIG_FILE)
+                                title=[f'Arch Linux @{pretty_ts}'], efi=["/EFI/Arch/lifeboat_12345_linux.efi"], sort_key=["linux"], version=["-linux5.19-12345"], type=EXPLICIT_CONFIG_FILE)
             ),
             Test(
                 name="simple linux entry",
                 config=Config(path=os.path.join(self.tmp.name, "loader/entries/arch.conf"), root=self.tmp.name,
                               title=['Arch Linux'], linux=['/vmlinuz-linux'], initrd=['/initramfs-linux.img'], sort_key=["linux"], version=["linux5.19"], type=EXPLICIT_CONFIG_FILE, autosave=True),
                 expected=Config(path=os.path.join(self.tmp.name, "loader/entries/lifeboat_12345_arch.conf"), root=self.tmp.name,
-                                title=[f'Arch Linux @{pretty_date(ts)}'], linux=["/lifeboat_12345_vmlinuz-linux"], initrd=["/lifeboat_12345_initramfs-linux.img"], sort_key=["linux"], version=["-linux5.19-12345"], type=EXPLICIT_CONFIG_FILE)
+                                title=[f'Arch Linux @{pretty_ts}'], linux=["/lifeboat_12345_vmlinuz-linux"], initrd=["/lifeboat_12345_initramfs-linux.img"], sort_key=["linux"], version=["-linux5.19-12345"], type=EXPLICIT_CONFIG_FILE)
             ),
             Test(
                 name="auto-generated efi path",
                 config=Config(path=os.path.join(self.tmp.name, "/EFI/Arch/linux.efi"), root=self.tmp.name,
                               title=['Arch Linux'], linux=['/EFI/Arch/linux.efi'], sort_key=["linux"], version=["linux5.19"], type=AUTO_EFI_CONFIG, autosave=True),
                 expected=Config(path=os.path.join(self.tmp.name, "loader/entries/lifeboat_12345_linux.conf"), root=self.tmp.name,
-                                title=[f'Arch Linux @{pretty_date(ts)}'], linux=["/EFI/Arch/lifeboat_12345_linux.efi"], sort_key=["linux"], version=["-linux5.19-12345"], type=EXPLICIT_CONFIG_FILE)
+                                title=[f'Arch Linux @{pretty_ts}'], linux=["/EFI/Arch/lifeboat_12345_linux.efi"], sort_key=["linux"], version=["-linux5.19-12345"], type=EXPLICIT_CONFIG_FILE)
             ),
             Test(
                 name="linux with multiple initrd",
@@ -103,7 +205,7 @@ class TestConfig(unittest.TestCase):
                                       '/intel-ucode.img', '/amd-ucode.img'],
                               sort_key=["linux"], version=["linux5.19"], autosave=True, type=EXPLICIT_CONFIG_FILE),
                 expected=Config(path=os.path.join(self.tmp.name, "loader/entries/lifeboat_12345_arch.conf"), root=self.tmp.name,
-                                title=[f'Arch Linux @{pretty_date(ts)}'], linux=["/lifeboat_12345_vmlinuz-linux"],
+                                title=[f'Arch Linux @{pretty_ts}'], linux=["/lifeboat_12345_vmlinuz-linux"],
                                 initrd=["/lifeboat_12345_initramfs-linux.img",
                                         "/lifeboat_12345_intel-ucode.img", '/lifeboat_12345_amd-ucode.img'],
                                 sort_key=["linux"], version=["-linux5.19-12345"], type=EXPLICIT_CONFIG_FILE)
@@ -112,37 +214,62 @@ class TestConfig(unittest.TestCase):
         for test in tests:
             with self.subTest(test['name']):
                 self.reset()
-                with open(os.path.join(self.tmp.name, 'EFI', 'Arch', 'linux.efi'), 'w') as fp:
-                    fp.write('my cool efi')
-
-                with open(os.path.join(self.tmp.name, 'vmlinuz-linux'), 'w') as fp:
-                    fp.write('my cool /linux')
-
-                with open(os.path.join(self.tmp.name, 'initramfs-linux.img'), 'w') as fp:
-                    fp.write('my cool /initramfs-linux.img')
-
-                with open(os.path.join(self.tmp.name, 'intel-ucode.img'), 'w') as fp:
-                    fp.write('my cool /intel-ucode.img')
-
-                with open(os.path.join(self.tmp.name, 'amd-ucode.img'), 'w') as fp:
-                    fp.write('my cool /amd-ucode.img')
+                self.seed()
 
                 self.assertEqual(test['expected'], dc.replace(test['config'].create_lifeboat(ts), autosave=False))
 
                 if test['config'].efi:
-                    with open('/'.join([test['expected'].root, test['expected'].efi[0]]), encoding='utf8') as fp:
-                        self.assertEqual('my cool efi', fp.read())
+                    self.assertEqual(b'my cool efi', read_mapped(
+                        '/'.join([test['expected'].root, test['expected'].efi[0]])))
 
                 if test['config'].linux and test['config'].type == EXPLICIT_CONFIG_FILE:
-                    with open('/'.join([test['expected'].root, test['expected'].linux[0]]), encoding='utf8') as fp:
-                        self.assertEqual('my cool /linux', fp.read())
+                    self.assertEqual(b'my cool /linux', read_mapped(
+                        '/'.join([test['expected'].root, test['expected'].linux[0]])))
                 if test['config'].linux and test['config'].type == AUTO_EFI_CONFIG:
-                    with open('/'.join([test['expected'].root, test['expected'].linux[0]]), encoding='utf8') as fp:
-                        self.assertEqual('my cool efi', fp.read())
+                    self.assertEqual(b'my cool efi', read_mapped(
+                        '/'.join([test['expected'].root, test['expected'].linux[0]])))
 
                 for name, path in zip(test['config'].initrd, test['expected'].initrd):
-                    with open('/'.join([test['expected'].root, path]), encoding='utf8') as fp:
-                        self.assertEqual(f'my cool {name}', fp.read())
+                    self.assertEqual(f'my cool {name}'.encode('utf8'), read_mapped(
+                        '/'.join([test['expected'].root, path])))
+
+    def test_create_lifeboat_copies_every_field(self):
+        with open(os.path.join(self.tmp.name, 'EFI', 'Arch', 'linux.efi'), 'w') as fp:
+            fp.write('my cool efi')
+        config = Config(path=os.path.join(self.tmp.name, "loader/entries/arch.conf"), root=self.tmp.name,
+                        is_default=True, title=['Arch Linux'], version=["linux5.19"], machine_id=['abc123'],
+                        sort_key=["linux"], efi=["/EFI/Arch/linux.efi"], options=['root=/dev/sda2 rw'],
+                        devicetree=['/dtb/board.dtb'], devicetree_overlay=['/dtb/overlay.dtbo'], architecture=['x64'])
+        lifeboat = config.create_lifeboat(12345)
+        for field in ['is_default', 'machine_id', 'sort_key', 'options', 'devicetree', 'devicetree_overlay', 'architecture']:
+            with self.subTest(field):
+                self.assertEqual(getattr(config, field), getattr(lifeboat, field))
+
+    def test_create_lifeboat_across_filesystems(self):
+        with open(os.path.join(self.tmp.name, 'EFI', 'Arch', 'linux.efi'), 'w') as fp:
+            fp.write('my cool efi')
+        config = Config(path=os.path.join(self.tmp.name, "loader/entries/arch.conf"), root=self.tmp.name,
+                        title=['Arch Linux'], efi=["/EFI/Arch/linux.efi"], sort_key=["linux"], version=["linux5.19"])
+        with patch('os.copy_file_range', side_effect=OSError(errno.EXDEV, os.strerror(errno.EXDEV))):
+            config.create_lifeboat(12345)
+        with open(os.path.join(self.tmp.name, 'EFI', 'Arch', 'lifeboat_12345_linux.efi'), encoding='utf8') as fp:
+            self.assertEqual('my cool efi', fp.read())
+
+    def test_create_lifeboat_cleans_up_when_a_copy_fails(self):
+        with open(os.path.join(self.tmp.name, 'vmlinuz-linux'), 'w') as fp:
+            fp.write('my cool /linux')
+        with open(os.path.join(self.tmp.name, 'initramfs-linux.img'), 'w') as fp:
+            fp.write('my cool /initramfs-linux.img')
+        with open(os.path.join(self.tmp.name, 'lifeboat_12345_initramfs-linux.img'), 'w') as fp:
+            fp.write('existing lifeboat')
+
+        config = Config(path=os.path.join(self.tmp.name, "loader/entries/arch.conf"), root=self.tmp.name,
+                        title=['Arch Linux'], linux=['/vmlinuz-linux'], initrd=['/initramfs-linux.img'],
+                        sort_key=["linux"], version=["linux5.19"])
+        self.assertRaises(ValueError, lambda: config.create_lifeboat(12345))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'lifeboat_12345_vmlinuz-linux')))
+        with open(os.path.join(self.tmp.name, 'lifeboat_12345_initramfs-linux.img'), encoding='utf8') as fp:
+            self.assertEqual('existing lifeboat', fp.read())
 
     def test_equivalent(self):
         with open(os.path.join(self.tmp.name, 'EFI', 'Arch', 'linux.efi'), 'w') as fp:
@@ -151,6 +278,8 @@ class TestConfig(unittest.TestCase):
             fp.write('my cool efi')
         with open(os.path.join(self.tmp.name, 'EFI', 'Arch', 'different.efi'), 'w') as fp:
             fp.write('my other efi')
+        with open(os.path.join(self.tmp.name, 'EFI', 'Arch', 'same_size.efi'), 'w') as fp:
+            fp.write('my cool ef!')
 
         default_config = Config(path=os.path.join(self.tmp.name, "loader/entries/arch.conf"), root=self.tmp.name,
                                 title=['Arch Linux'], efi=["/EFI/Arch/linux.efi"])
@@ -187,11 +316,23 @@ class TestConfig(unittest.TestCase):
                 expected=True
             ),
             Test(
-                name="configs pointing to different efi files with the different md5 are not equivalent",
+                name="configs pointing to different efi files with different contents are not equivalent",
                 config=default_config,
                 compare=dc.replace(default_config, efi=['/EFI/Arch/different.efi']),
                 expected=False
             ),
+            Test(
+                name="configs pointing to different efi files with the same contents are equivalent",
+                config=default_config,
+                compare=dc.replace(default_config, efi=['/EFI/Arch/lifeboat_12345_linux.efi']),
+                expected=True
+            ),
+            Test(
+                name="configs pointing to different efi files with the same size but different contents are not equivalent",
+                config=default_config,
+                compare=dc.replace(default_config, efi=['/EFI/Arch/same_size.efi']),
+                expected=False
+            ),
             Test(name="configs missing files are not equivalent",
                  config=default_config,
                  compare=dc.replace(default_config, efi=[]),
@@ -204,20 +345,45 @@ class TestConfig(unittest.TestCase):
                 actual = test['config'].equivalent(test['compare'])
                 self.assertEqual(test['expected'], actual)
 
+    @unittest.skipUnless(shutil.which('b2sum'), 'b2sum is not installed')
+    def test_external_hash_matches_hashlib(self):
+        for name in ['linux.efi', 'b\\x.efi', 'new\nline.efi']:
+            with self.subTest(name):
+                filepath = f'/EFI/Arch/{name}'
+                with open(os.path.join(self.tmp.name, 'EFI', 'Arch', name), 'w') as fp:
+                    fp.write('my cool efi')
+                with RootHandle(self.tmp.name) as root:
+                    fingerprint = root.fingerprint(filepath)
+
+                _cached_content_hash.cache_clear()
+                expected = _cached_content_hash(self.tmp.name, filepath, fingerprint)
+                _cached_content_hash.cache_clear()
+                with patch('systemd_boot_lifeboat.EXTERNAL_HASH_MIN_SIZE', 0):
+                    self.assertEqual(expected, _cached_content_hash(self.tmp.name, filepath, fingerprint))
+                _cached_content_hash.cache_clear()
+
 
 class TestChroot(unittest.TestCase):
-    def setUp(self):
-        self.maxDiff = None
-        self.tmp = TemporaryDirectory()
-        self.tmp2 = TemporaryDirectory()
-        os.makedirs(os.path.join(self.tmp.name, 'a', 'b', 'c'), exist_ok=True)
-        os.makedirs(os.path.join(self.tmp2.name, 'a', 'b', 'c'), exist_ok=True)
+    @classmethod
+    def setUpClass(cls):
+        cls.slash_inode = inode('/')
+        cls.template = temporary_directory()
+        os.makedirs(os.path.join(cls.template.name, 'a', 'b', 'c'))
         for path in ['a/a.txt', 'a/b/b.txt', 'a/b/c/c.txt']:
-            with open(os.path.join(self.tmp.name, path), 'w', encoding='utf8') as fp:
-                fp.write(path)
-            with open(os.path.join(self.tmp2.name, path), 'w', encoding='utf8') as fp:
+            with open(os.path.join(cls.template.name, path), 'w', encoding='utf8') as fp:
                 fp.write(path)
 
+    @classmethod
+    def tearDownClass(cls):
+        cls.template.cleanup()
+
+    def setUp(self):
+        self.maxDiff = None
+        self.tmp = temporary_directory()
+        self.tmp2 = temporary_directory()
+        copy_template(self.template, self.tmp.name)
+        copy_template(self.template, self.tmp2.name)
+
         if os.getuid() != 0:
             self.skipTest('Must run unit tests as root')
 
@@ -248,27 +414,62 @@ class TestChroot(unittest.TestCase):
                         roots.append(self.tmp.name + path[3:])
                 initial_fd_count = fd_count()
                 expected_inodes = [inode(x) for x in roots]
-                expected_inodes_after_exit = [x for x in reversed(expected_inodes[:-1])]
-                expected_inodes_after_exit.append(inode('/'))
+                # Exiting walks back through the same roots, ending at the real /
+                expected_inodes_after_exit = expected_inodes[-2::-1] + [self.slash_inode]
                 chroots = [Chroot(x) for x in roots]
 
                 for chroot, expected_inode in zip(chroots, expected_inodes):
                     chroot.__enter__()
                     self.assertEqual(expected_inode, inode('/'))
-                    pass
 
                 for chroot, expected_inode in zip(reversed(chroots), expected_inodes_after_exit):
                     chroot.__exit__(None, None, None)
                     self.assertEqual(expected_inode, inode('/'))
 
                 self.assertEqual(initial_fd_count, fd_count())
-                pass
+
+
+class TestRootHandle(unittest.TestCase):
+    def setUp(self):
+        self.maxDiff = None
+        self.tmp = temporary_directory()
+        os.makedirs(os.path.join(self.tmp.name, 'a'), exist_ok=True)
+        with open(os.path.join(self.tmp.name, 'a', 'a.txt'), 'w', encoding='utf8') as fp:
+            fp.write('a/a.txt')
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+        super().tearDown()
+
+    def test_resolves_absolute_paths_under_the_root(self):
+        initial_fd_count = fd_count()
+        with RootHandle(self.tmp.name) as root:
+            with os.fdopen(root.open('/a/a.txt', os.O_RDONLY), 'r', encoding='utf8') as fp:
+                self.assertEqual('a/a.txt', fp.read())
+            self.assertEqual(inode(os.path.join(self.tmp.name, 'a', 'a.txt')), root.stat('/a/a.txt').st_ino)
+            root.remove('/a/a.txt')
+        self.assertFalse(os.path.exists(os.path.join(self.tmp.name, 'a', 'a.txt')))
+        self.assertEqual(initial_fd_count, fd_count())
+
+    def test_parent_of_the_root_is_the_root(self):
+        root_path = os.path.join(self.tmp.name, 'a')
+        outside_path = os.path.join(self.tmp.name, 'a.txt')
+        with open(outside_path, 'w', encoding='utf8') as fp:
+            fp.write('outside')
+        with RootHandle(root_path) as root:
+            fingerprint = root.fingerprint('/../a.txt')
+            self.assertEqual(inode(os.path.join(root_path, 'a.txt')), fingerprint.ino)
+            self.assertEqual(_cached_content_hash(root_path, '/a.txt', fingerprint),
+                             _cached_content_hash(root_path, '/../a.txt', fingerprint))
+            root.remove('/../a.txt')
+        self.assertFalse(os.path.exists(os.path.join(root_path, 'a.txt')))
+        self.assertTrue(os.path.exists(outside_path))
 
 
 class TestFileTracker(unittest.TestCase):
     def setUp(self):
         self.maxDiff = None
-        self.tmp = TemporaryDirectory()
+        self.tmp = temporary_directory()
         if os.getuid() != 0:
             self.skipTest('Must run unit tests as root')
 
@@ -319,32 +520,54 @@ class TestFileTracker(unittest.TestCase):
             self.assertEqual('hello', fp.read())
 
 
-def fd_count() -> int: return len(os.listdir("/proc/self/fd")) - 1
+def read_mapped(path: str) -> bytes:
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, prot=mmap.PROT_READ) as mapped:
+        return mapped[:]
+
+
+def fd_count() -> int:
+    # Count in place instead of building a list of names. The -1 excludes the fd scandir itself holds open
+    with os.scandir("/proc/self/fd") as it:
+        return sum(1 for _ in it) - 1
+
+
 def inode(path) -> int: return os.stat(path).st_ino
 
 
 class TestEndToEnd(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.template = esp_template()
+
+        # Patch once for the whole class, forwarding to whichever test is currently running
+        cls.active_holder: list[TestEndToEnd] = []
+        cls.patcher = patch('systemd_boot_lifeboat.get_bootctl_entries', lambda *args,
+                            **kwargs: cls.active_holder[0].mock_bootctl_entries(*args, **kwargs))
+        cls.patcher.start()
+        cls.nowpatcher = patch('systemd_boot_lifeboat.now', lambda: cls.active_holder[0].ts)
+        cls.nowpatcher.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.patcher.stop()
+        cls.nowpatcher.stop()
+        cls.template.cleanup()
+
     def setUp(self):
         self.maxDiff = None
-        self.tmp = TemporaryDirectory()
-        os.makedirs(os.path.join(self.tmp.name, 'loader', 'entries'), exist_ok=True)
-        os.makedirs(os.path.join(self.tmp.name, 'EFI', 'Arch'), exist_ok=True)
+        self.tmp = temporary_directory()
+        copy_template(self.template, self.tmp.name)
 
         if os.getuid() != 0:
             self.skipTest('Must run unit tests as root')
 
-        self.patcher = patch('systemd_boot_lifeboat.get_bootctl_entries', lambda *args,
-                             **kwargs: self.mock_bootctl_entries(*args, **kwargs))
-        self.patcher.start()
-
         self.ts = 12345
-        self.nowpatcher = patch('systemd_boot_lifeboat.now', lambda: self.ts)
-        self.nowpatcher.start()
+        self.config_cache: Dict[str, tuple[tuple[int, int, int], Config]] = {}
+        self.active_holder[:] = [self]
 
     def tearDown(self) -> None:
         self.tmp.cleanup()
-        self.patcher.stop()
-        self.nowpatcher.stop()
+        self.active_holder.clear()
         super().tearDown()
 
     def test_end_to_end(self):
@@ -363,8 +586,8 @@ class TestEndToEnd(unittest.TestCase):
         runner()
         self.assertEqual(expected_default_config, self.load_config(expected_default_config.path))
         first_lifeboat = self.load_config(os.path.join(self.tmp.name, 'loader/entries/lifeboat_12345_arch.conf'))
-        self.assertListEqual(sorted([expected_default_config, first_lifeboat]),
-                             sorted(self.mock_bootctl_entries()))
+        self.assertSetEqual({expected_default_config, first_lifeboat},
+                            set(self.mock_bootctl_entries()))
         self.assertTrue(first_lifeboat.equivalent(expected_default_config))
         with open(os.path.join(self.tmp.name, 'EFI', 'Arch', 'lifeboat_12345_linux.efi'), 'r', encoding='utf8') as fp:
             self.assertEqual("my cool efi", fp.read())
@@ -376,8 +599,8 @@ class TestEndToEnd(unittest.TestCase):
 
         # Calling the runner when the efi has changed should result in no changes
         runner()
-        self.assertListEqual(sorted([expected_default_config, first_lifeboat]),
-                             sorted(self.mock_bootctl_entries()))
+        self.assertSetEqual({expected_default_config, first_lifeboat},
+                            set(self.mock_bootctl_entries()))
 
         # Now if the efi file changes, we should create a new entry
         with open(os.path.join(self.tmp.name, 'EFI', 'Arch', 'linux.efi'), 'w') as fp:
@@ -385,8 +608,8 @@ class TestEndToEnd(unittest.TestCase):
         self.ts = 12348
         runner()
         second_lifeboat = self.load_config(os.path.join(self.tmp.name, 'loader/entries/lifeboat_12348_arch.conf'))
-        self.assertListEqual(sorted([expected_default_config, first_lifeboat, second_lifeboat]),
-                             sorted(self.mock_bootctl_entries()))
+        self.assertSetEqual({expected_default_config, first_lifeboat, second_lifeboat},
+                            set(self.mock_bootctl_entries()))
         with open(os.path.join(self.tmp.name, 'EFI', 'Arch', 'lifeboat_12348_linux.efi'), 'r', encoding='utf8') as fp:
             self.assertEqual("my cool efi2", fp.read())
 
@@ -396,24 +619,28 @@ class TestEndToEnd(unittest.TestCase):
         self.ts = 12349
         runner()
         third_lifeboat = self.load_config(os.path.join(self.tmp.name, 'loader/entries/lifeboat_12349_arch.conf'))
-        self.assertListEqual(sorted([expected_default_config, second_lifeboat, third_lifeboat]),
-                             sorted(self.mock_bootctl_entries()))
+        self.assertSetEqual({expected_default_config, second_lifeboat, third_lifeboat},
+                            set(self.mock_bootctl_entries()))
         self.assertTrue(third_lifeboat.equivalent(expected_default_config))
 
-    def load_config(self, filepath: str) -> Config:
+    def load_config(self, filepath: str, st: Optional[os.stat_result] = None) -> Config:
+        # Only re-parse files that changed since the last time they were loaded
+        st = st or os.stat(filepath)
+        signature = (st.st_ino, st.st_size, st.st_mtime_ns)
+        cached = self.config_cache.get(filepath)
+        if cached and cached[0] == signature:
+            return cached[1]
+
         config = Config(path=filepath, root=self.tmp.name, autosave=False)
-        with open(filepath, 'r', encoding='utf8') as fp:
-            for line in fp.readlines():
-                key, val = line.strip().split(maxsplit=1)
-                key = re.sub('-', '_', key).lower()
-                existing = getattr(config, key)
-                existing.append(val)
+        for match in ENTRY_RE.finditer(Path(filepath).read_bytes()):
+            key = match.group(1).translate(DASH_TO_UNDERSCORE).lower().decode('utf8')
+            getattr(config, key).append(match.group(2).decode('utf8'))
+        self.config_cache[filepath] = (signature, config)
         return config
 
     def mock_bootctl_entries(self):
-        filepaths = [os.path.join(self.tmp.name, 'loader', 'entries', name)
-                     for name in os.listdir(os.path.join(self.tmp.name, 'loader', 'entries'))]
-        return [self.load_config(x) for x in filepaths]
+        with os.scandir(os.path.join(self.tmp.name, 'loader', 'entries')) as it:
+            return [self.load_config(entry.path, entry.stat()) for entry in it if entry.is_file(follow_symlinks=False)]
 
 
 if 'unittest.util' in __import__('sys').modules: